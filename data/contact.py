@@ -20,14 +20,95 @@ import os
 import pandas as pd
 import re
 import unidecode
-import requests
 import json
+import threading
 import country_list
 
 import vobject as vo
 from data.nominatim import Nominatim
 from data.spellcheck import GeoSpellChecker
 from urllib.parse import urlencode
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# Cleanup of the Vcard tags, applied in this order on each cell
+_VCARD_CLEANUPS = [
+  # 1. Basic tags : [<fn{} name>] -> name
+  (re.compile(r"\[\<\S+\{\}(.*)\>\]"), r"\1"),
+  # 2. Tags with nested types : [<adr{'TYPE': ['HOME']} value>] -> "HOME: value"
+  (re.compile(r"\<\S+\{'?[A-Z]*'?:?\s?\[?'?([A-Z]*)'?\]?\}([^;\]]*)\>"), r"\1: \2"),
+  # 3. Remove leading empty elements separated by comas, and multiple spaces
+  (re.compile(r"^\s*,\s*[^\S]*|[ ]{2,}"), " "),
+]
+
+# Location hint cleanup, in a single pass:
+# 1. remove content into parenthesis because it's usually precisions and Nominatim will not be able to parse it
+# 2. replace dashes and special characters by spaces
+# 3. replace line breaks by commas
+_GEOHINT_CLEANUP = re.compile(r"((?:\(|\@ESCAPEDLEFTPARENTHESIS\@).*(?:\)|\@ESCAPEDRIGHTPARENTHESIS\@))|([\-\[\]\{\}]+)|([\n\r]+)")
+
+# vCard tags, possibly with accentuated characters
+_VCARD_TAG = re.compile(r"^([A-ZÉÈÊÀÃ\-\;]+):", re.MULTILINE)
+
+# Address types prefixes (HOME: , WORK: ) splitting multiple addresses
+_SPLIT_ADDR = re.compile(r"[A-Z]+: ")
+
+# Multiple or orphaned commas
+_COMMA_RUN = re.compile(r"(\s?\,)+")
+
+# Multiple + in URL-encoded queries
+_PLUS_RUN = re.compile(r"[\+]+")
+
+
+def _clean_vcard_value(text):
+  for pattern, replacement in _VCARD_CLEANUPS:
+    text = pattern.sub(replacement, text)
+  return text
+
+
+def _unidecode(text):
+  # Most of the text is already ASCII, don't go through unidecode for it
+  return text if text.isascii() else unidecode.unidecode(text, errors="ignore")
+
+
+# vCard tags repeat heavily across lines and files, remember their ASCII version
+_tag_cache = {}
+
+
+def _unidecode_tag(match):
+  tag = match.group(1)
+  if tag not in _tag_cache:
+    _tag_cache[tag] = _unidecode(tag)
+  return _tag_cache[tag] + ":"
+
+
+def _clean_geohint(match):
+  return ", " if match.group(3) else " "
+
+
+def _parse_vcf_file(path):
+  """
+  Read and parse a single .vcf file
+  :param path: path of the .vcf file
+  :return: the fields of the vcard as a Python dict of cleaned-up strings
+  """
+  content = Path(path).read_text(encoding="utf-8")
+
+  # Remove accentuated characters in vCard tags
+  # Otherwise it makes some vobject fail (actually, the codec lib it uses)
+  # Also… what stupid vCard app allows them ???
+  # Pure ASCII files, the common case, can't have any.
+  if not content.isascii():
+    content = _VCARD_TAG.sub(_unidecode_tag, content)
+
+  # Get the inner of the vcard as a Python dict
+  parsed = vo.readOne(content).contents
+
+  # Render each field as clean text right away, so the database gets built from plain strings
+  contact = {key: _clean_vcard_value(str(values)) for key, values in parsed.items()}
+  contact["file"] = path
+  return contact
 
 
 def list_vcf_in_directory(directory, progress=None, killswitch=None):
@@ -36,54 +117,45 @@ def list_vcf_in_directory(directory, progress=None, killswitch=None):
   :param progress: Qt Worker Signal to emit progress info
   :param killswitch: Thread-safe boolean stopping the process if == True
   """
-  contacts = []
-  all_files = os.listdir(directory)
-  files_number = len(all_files)
+  # Walk the directory to find all .vcf files
+  paths = sorted(entry.path for entry in os.scandir(directory)
+                 if entry.name.endswith(".vcf") and entry.is_file())
+  files_number = len(paths)
+  contacts = [None] * files_number
   current_file = 0
 
-  # Walk the directory to find al files
-  for file in sorted(all_files):
+  # Files are independent, so read and parse them in parallel.
+  # Progress and killswitch are handled here, in the calling thread, as files complete.
+  executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+  try:
+    futures = {executor.submit(_parse_vcf_file, path): i for i, path in enumerate(paths)}
 
-    # Update the progress bar if any
-    if progress is not None:
-      progress.emit((current_file, 0, files_number, "Parsing files", "Reading directory"))
-      current_file += 1
+    for future in as_completed(futures):
 
-    # Abort and update the progress bar on killswitch
-    if killswitch is not None and killswitch.is_set():
+      # Update the progress bar if any
       if progress is not None:
-        progress.emit((current_file, 0, current_file, files_number, "cancel", "Reading directory"))
-      break
-
-    if file.endswith(".vcf"):
-
-      path = os.path.join(directory, file)
-      f = open(path, "r")
-      content = f.read()
-      f.close()
-
-      content.encode(encoding='UTF-8', errors='strict')
+        progress.emit((current_file, 0, files_number, "Parsing files", "Reading directory"))
+      current_file += 1
 
-      # Remove accentuated characters in vCard tags
-      # Otherwise it makes some vobject fail (actually, the codec lib it uses)
-      # Also… what stupid vCard app allows them ???
-      regex = r"^([A-ZÉÈÊÀÃ\-\;]+):"
-      matches = re.finditer(regex, content, re.MULTILINE)
+      # Abort and update the progress bar on killswitch
+      if killswitch is not None and killswitch.is_set():
+        if progress is not None:
+          progress.emit((current_file, 0, current_file, files_number, "cancel", "Reading directory"))
+        break
 
-      for matchNum, match in enumerate(matches):
-        tag = match.group(1)
-        content = content.replace(tag, unidecode.unidecode(tag))
+      # Keep the contacts in the order of the files
+      contacts[futures[future]] = future.result()
+  finally:
+    # Don't parse the remaining files if we got killed or a file failed to parse
+    executor.shutdown(wait=True, cancel_futures=True)
 
-      # Get the inner of the vcard as a Python dict
-      parsed = vo.readOne(content).contents
-      parsed["file"] = path
-      contacts.append(parsed)
+  contacts = [contact for contact in contacts if contact is not None]
 
   if progress is not None:
     progress.emit((current_file, files_number, files_number, "Parsing files", "Reading directory"))
 
   # Collapse this into a database, aka Pandas DataFrame
-  data = pd.DataFrame(contacts)
+  data = pd.DataFrame.from_records(contacts)
 
   return data
 
@@ -95,7 +167,7 @@ def cleanup_contact(data, progress=None, killswitch=None):
   """
 
   if progress is not None:
-    progress.emit((0, 0, 3, "Formatting the database", "Prepare data"))
+    progress.emit((0, 0, 2, "Formatting the database", "Prepare data"))
 
   # Cleanup fully empty columns
   data.dropna(axis=1, how="all", inplace=True)
@@ -103,46 +175,116 @@ def cleanup_contact(data, progress=None, killswitch=None):
   # Replace NaN by empty string to not pollute the view
   data.fillna("", inplace=True)
 
-  # Convert to string to be able to regex on it
-  data = data.astype("str")
-
-  if progress is not None:
-    progress.emit((1, 0, 3, "Cleaning tags", "Prepare data"))
-
-  # Cleanup the Vcard tags
-  # 1. Basic tags : [<fn{} name>] -> name
-  data.replace(to_replace="\[\<\S+\{\}(.*)\>\]", value=r"\1", regex=True, inplace=True)
-  # 2. Tags with nested types : [<adr{'TYPE': ['HOME']} value>] -> "HOME: value"
-  data.replace(to_replace="\<\S+\{'?[A-Z]*'?:?\s?\[?'?([A-Z]*)'?\]?\}([^;\]]*)\>", value=r"\1: \2", regex=True, inplace=True)
-  # 3. Remove multiple spaces
-  data.replace(to_replace="[ ]{2,}", value=" ", regex=True, inplace=True)
-  # 4. Remove leading empty elements separated by comas
-  data.replace(to_replace="^\s*,\s*[^\S]*", value=" ", regex=True, inplace=True)
-
   if progress is not None:
-    progress.emit((2, 0, 3, "Sorting data", "Prepare data"))
+    progress.emit((1, 0, 2, "Sorting data", "Prepare data"))
 
   # Reorder columns in a way that makes sense :
   # 1. start with typical ID and adresses/phone (default vCard fields)
   # 2. end with X-(.*) (custom user-defined fields)
   # 3. fill the middle with the rest of default VCard fields
 
-  original_cols = sorted(list(data.columns.tolist()))
   forced_cols_start = ["categories", "fn", "n", "org", "role", "email", "adr", "tel"]
-
-  for elem in forced_cols_start:
-    if elem in original_cols:
-      original_cols.remove(elem)
+  forced_cols_set = set(forced_cols_start)
+  original_cols = sorted(col for col in data.columns if col not in forced_cols_set)
 
   cols = forced_cols_start + original_cols
   data = data.reindex(columns=cols)
 
   if progress is not None:
-    progress.emit((3, 0, 3, "Sorted", "Prepare data"))
+    progress.emit((2, 0, 2, "Sorted", "Prepare data"))
 
   return data
 
 
+def _geolocate(decoded, nominatim, spellchecker, stop, killswitch=None):
+  """
+  Find the Nominatim entries matching a decoded location hint
+  :param decoded: location hint, possibly containing several addresses
+  :param nominatim: Nominatim instance, shared between threads
+  :param spellchecker: GeoSpellChecker instance used to identify countries
+  :param stop: threading.Event set by the caller to abort before the next query
+  :param killswitch: Thread-safe boolean stopping the process if == True
+  :return: (list of Nominatim entries, True if the first guess matched exactly)
+  """
+  result = []
+
+  # We may have more than one address per contact (home, office, etc.)
+  split = _SPLIT_ADDR.split(decoded)
+
+  flag_accurate =  False
+
+  # Checked between queries, and by Nominatim once it's our turn to query the server,
+  # so no request is sent once we got killed
+  def stopped():
+    return stop.is_set() or (killswitch is not None and killswitch.is_set())
+
+  for elem in split:
+    if stopped():
+      break
+
+    elem = elem.strip(" \n\r.;,:").lower()
+
+    # Factorize multiple or orphaned commas
+    elem = _COMMA_RUN.sub(",", elem)
+
+    if len(str(elem)) != 0:
+      try:
+        query = urlencode({'q': elem,
+                           'format': 'json'})
+        query = _PLUS_RUN.sub("+", query).strip("+")
+        out = nominatim.fetch_cache_or_web(query, stopped)[0]
+        result.append(out)
+
+        # We found an exact match
+        flag_accurate = True
+      except:
+        # Third guess: try to remove the country name and replace it by the ISO code
+        # Nominatim fails if the country name is not in the same language as the rest
+        # of the address,
+        # Note: It's not accurate.
+        # Ex 1: US State "Georgia" may get identified as the country.
+        # Ex 2: If the streetname is a country, the address may also fall in the wrong country
+        if stopped():
+          break
+
+        (country_code, filtered) = spellchecker.get_country_code_from_text(elem)
+
+        try:
+          query = urlencode({'q': filtered,
+                             'countrycodes': country_code,
+                             'format': 'json'})
+          query = _PLUS_RUN.sub("+", query).strip("+")
+          out = nominatim.fetch_cache_or_web(query, stopped)[0]
+          result.append(out)
+        except:
+          # Sometimes, the query fails for being too specific
+          # In that case, we retry with the n last elements, from n = length - 1 down to 1,
+          # then just the first element
+          parts = [part.strip() for part in filtered.split(",")]
+          candidates = [",".join(parts[-n:]) for n in range(len(parts) - 1, 0, -1)] + [parts[0]]
+
+          for q in candidates:
+            if stopped():
+              break
+
+            try:
+              query = urlencode({'q': q,
+                                 'countrycodes': country_code,
+                                 'format': 'json'})
+              query = _PLUS_RUN.sub("+", query).strip("+")
+              out = nominatim.fetch_cache_or_web(query, stopped)[0]
+              result.append(out)
+              break
+            except:
+              continue
+          else:
+            # Going below one element is simply too risky
+            # Abort here
+            print(elem, "not found")
+
+  return (result, flag_accurate)
+
+
 def get_geoID(data, progress=None, killswitch=None):
   """
   Thread-safe address book building
@@ -154,41 +296,40 @@ def get_geoID(data, progress=None, killswitch=None):
   if progress is not None:
     progress.emit((0, 0, entries, "Downloading GPS coordinates from nominatim.org…", "Fetch geolocation data"))
 
-  # Try to see if https://nominatim.openstreetmap.org/search is available
-  # If not, the DB will be unavailable
-  try:
-    response = requests.get('https://nominatim.openstreetmap.org/search')
-  except:
-    if progress is not None:
-      progress.emit((0, 0, entries, "nominatim.org can't be reached, geolocation will use the local cache if possible", "Fetch geolocation data"))
-
   # Get the OSM area ID
   # This can be slow and long since we need to download info from the Nominatim DB
   # However, results are cached, so the next time will run faster
-  # To be able to re-use the cache, we actually need to process that single-threaded and sequentially.
-  # Also, it wouldn't be nice to DoS the free OSM servers with too many requests per second.
+  # Network requests are serialized by the Nominatim object, since it wouldn't be nice
+  # to DoS the free OSM servers with too many requests per second.
   # See conditions of service use : https://operations.osmfoundation.org/policies/nominatim/
   nominatim = Nominatim()
 
+  # Try to see if https://nominatim.openstreetmap.org/search is available
+  # If not, the DB will be unavailable
+  if not nominatim.is_online():
+    if progress is not None:
+      progress.emit((0, 0, entries, "nominatim.org can't be reached, geolocation will use the local cache if possible", "Fetch geolocation data"))
+
   # Quick way for reference:
   # Since it's not purely data processing in here, there is no point doing that
   #data['geoID'] = data.apply(lambda row : nominatim.query(re.sub(r"\[[A-Z]+:?\s?\n?([\s\S]*)\]", r"\1", row['adr'].replace("\n", ""))).toJSON(), axis = 1)
 
   # Get a clean location hint
-  data['geohint'] = data['adr']
-
-  # Remove content into parenthesis because it's usually precisions and Nominatim will not be able to parse it
-  data['geohint'].replace(to_replace="(?:\(|\@ESCAPEDLEFTPARENTHESIS\@).*(?:\)|\@ESCAPEDRIGHTPARENTHESIS\@)", value=" ", regex=True, inplace=True)
-
-  # Replace dashes and special characters by spaces
-  data['geohint'].replace(to_replace="[\-\[\]\{\}]+", value=" ", regex=True, inplace=True)
-  data['geohint'].replace(to_replace="[\n\r]+", value=", ", regex=True, inplace=True)
+  data['geohint'] = data['adr'].str.replace(_GEOHINT_CLEANUP, _clean_geohint, regex=True)
 
   # Factorize multiple spaces
-  data['geohint'].replace(to_replace="\s+", value=" ", regex=True)
+  data['geohint'] = data['geohint'].str.replace(r"\s+", " ", regex=True)
 
   # Remove leading empty elements separated by comas
-  data['geohint'].replace(to_replace="^\s*,\s*[^\S]", value="", regex=True, inplace=True)
+  data['geohint'] = data['geohint'].str.replace(r"^\s*,\s*[^\S]", "", regex=True)
+
+  # Decode Unicode
+  decoded_hints = data['geohint'].map(_unidecode)
+
+  # Remove illegal characters left-over from bad encodings
+  decoded_hints = decoded_hints.str.replace("\"", "", regex=False)
+  decoded_hints = decoded_hints.str.replace("(c)", "", regex=False)
+  decoded_hints = decoded_hints.str.replace("@", "", regex=False)
 
   # Finally, apply some spell checking
   GeoSpellCheck = GeoSpellChecker(["fr", "en"])
@@ -196,108 +337,50 @@ def get_geoID(data, progress=None, killswitch=None):
   # Ensure index matches the number of rows, otherwise iterating over rows may not produce the expected result
   data.reset_index(drop=True, inplace=True)
 
-  # Go the slow way to be able to output the progress
-  for index, row in data.iterrows():
-    if progress is not None:
-      progress.emit((index, 0, entries, "Downloading GPS coordinates from nominatim.org…", "Fetch geolocation data"))
+  # Work on a plain array of hints rather than data.iterrows(),
+  # which builds a full pd.Series for each row
+  decoded_hints = decoded_hints.to_numpy()
+  geoIDs = ["not found"] * len(decoded_hints)
+  exact = [False] * len(decoded_hints)
+  done = 0
+
+  # Rows are geolocated in parallel: the ones found in the cache resolve immediately
+  # while Nominatim serializes the actual network requests to 1 per second.
+  # Progress and killswitch are handled here, in the calling thread, as rows complete.
+  stop = threading.Event()
+  executor = ThreadPoolExecutor(max_workers=8)
+  try:
+    futures = {executor.submit(_geolocate, decoded, nominatim, GeoSpellCheck, stop, killswitch): index
+               for index, decoded in enumerate(decoded_hints)}
 
-    # Abort and update the progress bar on killswitch
-    if killswitch is not None and killswitch.is_set():
+    for future in as_completed(futures):
       if progress is not None:
-        progress.emit((index, 0, index, "cancel", "Fetch geolocation data"))
-      break
-
-    result = []
-
-    # Decode Unicode
-    decoded = unidecode.unidecode(row['geohint'], errors="ignore")
-
-    # Remove illegal characters left-over from bad encodings
-    decoded = decoded.replace("\"", "")
-    decoded = decoded.replace("(c)", "")
-    decoded = decoded.replace("@", "")
-
-    # We may have more than one address per contact (home, office, etc.)
-    split = re.split(r"[A-Z]+: ", decoded)
-
-    flag_accurate =  False
-
-    for elem in split:
-      elem = elem.strip(" \n\r.;,:").lower()
-
-      # Factorize multiple or orphaned commas
-      elem = re.sub(r"(\s?\,)+", ",", elem)
-
-      if len(str(elem)) != 0:
-        try:
-          query = urlencode({'q': elem,
-                             'format': 'json'})
-          query = re.sub(r"[\+]+", "+", query).strip("+")
-          out = nominatim.fetch_cache_or_web(query)[0]
-          result.append(out)
-
-          # We found an exact match
-          flag_accurate = True
-        except:
-          # Third guess: try to remove the country name and replace it by the ISO code
-          # Nominatim fails if the country name is not in the same language as the rest
-          # of the address,
-          # Note: It's not accurate.
-          # Ex 1: US State "Georgia" may get identified as the country.
-          # Ex 2: If the streetname is a country, the address may also fall in the wrong country
-          (country_code, filtered) = GeoSpellCheck.get_country_code_from_text(elem)
-
-          try:
-            query = urlencode({'q': filtered,
-                               'countrycodes': country_code,
-                               'format': 'json'})
-            query = re.sub(r"[\+]+", "+", query).strip("+")
-            out = nominatim.fetch_cache_or_web(query)[0]
-            result.append(out)
-          except:
-            # Sometimes, the query fails for being too specific
-            # In that case, we retry all combinations of the n last elements
-            sub_elems = filtered.split(",")
-            found = False
-            for i in range(0, len(sub_elems) - 1, 1):
-              q = sub_elems[-1].strip()
-              # Build sub-query with the n-th last elements
-              # n = length - i > 1
-              for j in range(2, len(sub_elems) - i, +1):
-                q = sub_elems[-j].strip() + "," + q
-
-              try:
-                query = urlencode({'q': q,
-                                   'countrycodes': country_code,
-                                   'format': 'json'})
-                query = re.sub(r"[\+]+", "+", query).strip("+")
-                out = nominatim.fetch_cache_or_web(query)[0]
-                result.append(out)
-                found = True
-                break
-              except:
-                continue
-
-            if not found:
-              try:
-                # Try with just the first and last element
-                query = urlencode({'q': sub_elems[0].strip(),
-                                   'countrycodes': country_code,
-                                   'format': 'json'})
-                query = re.sub(r"[\+]+", "+", query).strip("+")
-                out = nominatim.fetch_cache_or_web(query)[0]
-                result.append(out)
-              except:
-                # Just using one element is simply too risky
-                # Abort here
-                print(elem, "not found")
-    if result:
-      data.loc[index, "geoID"] = json.dumps(result)
-    else:
-      data.loc[index, "geoID"] = "not found"
-    data.loc[index, "exactlocation"] = flag_accurate
+        progress.emit((done, 0, entries, "Downloading GPS coordinates from nominatim.org…", "Fetch geolocation data"))
+
+      # Abort and update the progress bar on killswitch
+      if killswitch is not None and killswitch.is_set():
+        if progress is not None:
+          progress.emit((done, 0, done, "cancel", "Fetch geolocation data"))
+        break
+
+      index = futures[future]
+      (result, flag_accurate) = future.result()
+      done += 1
+
+      if result:
+        geoIDs[index] = json.dumps(result, separators=(",", ":"), ensure_ascii=False)
+      exact[index] = flag_accurate
+  finally:
+    # If we got killed or a row failed, drop the pending rows and let the running ones
+    # abort before their next query, so nothing keeps querying the server after we return
+    stop.set()
+    executor.shutdown(wait=True, cancel_futures=True)
+
+  # Write the results back in one go instead of a scalar data.loc[] assignment per row
+  data['geoID'] = pd.Series(geoIDs, index=data.index, dtype="object")
+  data['exactlocation'] = pd.Series(exact, index=data.index, dtype="bool")
 
   if progress is not None:
-    progress.emit((index, entries, entries, "cancel", "Fetch geolocation data"))
+    progress.emit((done, entries, entries, "cancel", "Fetch geolocation data"))
 
   return data
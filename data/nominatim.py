@@ -22,6 +22,8 @@ import json
 import os
 import time
 import re
+import functools
+import threading
 
 
 # Configure the cache
@@ -36,55 +38,113 @@ if(not os.path.isdir(pref_path)):
 if(not os.path.isdir(cache_path)):
   os.mkdir(cache_path)
 
+# Share one connection pool between all queries, to keep the connection to the server alive
+# urllib3 retries are disabled: they would bypass the 1 s delay between requests below
+http = urllib3.PoolManager(num_pools=1, maxsize=8, retries=False, headers={
+  "Accept": "application/json",
+  "Content-Type": "application/json",
+  "Accept": "text/plain",
+  "User-Agent": "Open Contact book experimental"
+})
+
+
+# Only one thread at a time can query the server, to honour the 1 request/s policy
+# This is shared by all Nominatim instances, so a new run can't overlap the requests of a previous one
+server_lock = threading.Lock()
+last_request = 0.
+
+
+def canonical_query(query):
+  # Normalize an URL-encoded query so near-duplicates share the same cache entry:
+  # lowercase, no repeated spaces, no spaces around commas
+  query = query.lower()
+  query = re.sub(r"\++", "+", query)
+  query = re.sub(r"\+?%2c\+?", "%2c", query)
+  return query.strip("+")
+
+
+@functools.lru_cache(maxsize=100000)
+def read_cache_file(file):
+  # Cache files are immutable once written, so keep them in memory
+  with open(os.path.join(cache_path, file), "r") as f:
+    return json.loads(f.read())
+
+
 class Nominatim:
   def __init__(self):
-    self.timer = time.time()
+    # Index the cached queries once, instead of walking the cache directory for each query
+    # File names are query_timestamp
+    self.cache_index = {}
+    for file in sorted(os.listdir(cache_path)):
+      self.cache_index[canonical_query(file.rsplit("_", 1)[0])] = file
 
-  def fetch_cache_or_web(self, query):
+  def is_online(self):
+    # Check if the server can be reached
+    global last_request
+    with server_lock:
+      try:
+        http.request('GET', 'https://nominatim.openstreetmap.org/search')
+        return True
+      except:
+        return False
+      finally:
+        last_request = time.time()
+
+  def fetch_cache_or_web(self, query, stopped=None):
     # Lookup the cache for a query. If not found, fetch it on the server
-    all_files = os.listdir(cache_path)
-    now = int(time.time())
-
-    # Walk the directory to find all files
-    # Look for case-insensitive matches
-    for file in sorted(all_files):
-      if (file.lower()).startswith(query.lower()):
-        """
-        # Get the file timestamp
-        timestamp = re.search(r"\d+$", file)
-
-        if(now - int(timestamp.group(0)) > 5184000):
-          # if the cache is older than 60 days, flush it
-          print("Cache flushed for query", query)
-          os.remove(file)
-        else:
-        """
-        # the cache is new enough, use it
-        # print("Cache used for query", query)
-        with open(os.path.join(cache_path, file), "r") as f:
-          return json.loads(f.read())
+    # stopped: optional callable, if it returns True no request is sent and no result is returned
+    key = canonical_query(query)
+
+    if key in self.cache_index:
+      # print("Cache used for query", query)
+      return read_cache_file(self.cache_index[key])
 
     # No cache found, make it
-    http = urllib3.PoolManager(num_pools=1, headers={
-      "Accept": "application/json",
-      "Content-Type": "application/json",
-      "Accept": "text/plain",
-      "User-Agent": "Open Contact book experimental"
-    })
     url = 'https://nominatim.openstreetmap.org/search?' + query
 
-    # Check if previous request is more than 1 s old
-    # To comply with the conditions of use of the API
-    now = time.time()
-    time_passed = now - self.timer
-    if(time_passed < 1.): time.sleep(1. - time_passed)
+    global last_request
+    with server_lock:
+      # Another thread may have fetched the same query while we were waiting
+      if key in self.cache_index:
+        return read_cache_file(self.cache_index[key])
+
+      # We may have been killed while waiting for our turn
+      if stopped is not None and stopped():
+        return []
+
+      # Check if previous request is more than 1 s old
+      # To comply with the conditions of use of the API
+      # Retry a few times if the server is overloaded, waiting longer each time
+      delay = 1.
+      for attempt in range(4):
+        # Wait by small steps to abort quickly if we get killed meanwhile
+        remaining = delay - (time.time() - last_request)
+        while remaining > 0.:
+          if stopped is not None and stopped():
+            return []
+          time.sleep(min(0.1, remaining))
+          remaining = delay - (time.time() - last_request)
+
+        if stopped is not None and stopped():
+          return []
+
+        # Count failed requests too, so the next one still waits its turn
+        try:
+          r = http.request('GET', url)
+        finally:
+          last_request = time.time()
+
+        if r.status not in (429, 503):
+          break
+        delay *= 2.
 
-    r = http.request('GET', url)
-    self.timer = now
-    output = json.loads(r.data.decode('utf-8'))
+      now = last_request
+      output = json.loads(r.data.decode('utf-8'))
 
-    with open(os.path.join(cache_path, query.lower() + "_" + str(int(now))), "w") as file:
-      file.write(json.dumps(output))
+      file = key + "_" + str(int(now))
+      with open(os.path.join(cache_path, file), "w") as f:
+        f.write(json.dumps(output))
+      self.cache_index[key] = file
 
     print("Server used for query", query)
     return output
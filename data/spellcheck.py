@@ -50,6 +50,11 @@ class GeoSpellChecker:
     self.WORDS = Counter()
     for key, value in self.countries.items():
       self.WORDS.update(value)
+    self.N = sum(self.WORDS.values())
+
+    # Address tokens (cities, countries) repeat a lot across contacts,
+    # so remember the country code found for each of them
+    self.country_codes = {}
 
   def __init__(self, languages=["en"]):
     self.rebuild_dict(languages)
@@ -59,7 +64,7 @@ class GeoSpellChecker:
 
   def P(self, word):
       "Probability of `word`."
-      return self.WORDS[word] / sum(self.WORDS.values())
+      return self.WORDS[word] / self.N
 
   def correction(self, word):
       "Most probable spelling correction for word."
@@ -89,10 +94,17 @@ class GeoSpellChecker:
 
   def get_country_code_from_spell_check(self, word):
     "Perform a spell check and fetch the country code"
-    guess = self.correction(word.lower())
-    for key, value in self.countries.items():
-      if guess in value or guess in key:
-        return key
+    word = word.lower()
+    if word not in self.country_codes:
+      code = None
+      guess = self.correction(word)
+      for key, value in self.countries.items():
+        if guess in value or guess in key:
+          code = key
+          break
+      self.country_codes[word] = code
+
+    return self.country_codes[word]
 
   def get_country_code_from_text(self, text):
     """